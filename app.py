@@ -4,10 +4,19 @@ Main Flask application for displaying photos from Adobe Lightroom albums
 """
 
 import os
+import time
+import hashlib
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlparse
+import orjson
+import redis
 from flask import Flask, render_template, redirect, url_for, session, request, Response
+from flask.json.provider import JSONProvider
 from dotenv import load_dotenv
-from lightroom_client import LightroomClient
+from flask_session import Session
+from lightroom_client import LightroomClient, NOT_MODIFIED
 from oauth_handler import OAuthHandler
 
 # Load environment variables
@@ -27,13 +36,50 @@ logging.basicConfig(
 log_level = os.getenv('LOG_LEVEL', 'INFO').upper()
 logging.getLogger().setLevel(getattr(logging, log_level, logging.INFO))
 
+logger = logging.getLogger(__name__)
+
 # Load pagination settings from environment
-ALBUMS_PER_PAGE = int(os.getenv('ALBUMS_PER_PAGE', '8'))
-PHOTOS_PER_PAGE = int(os.getenv('PHOTOS_PER_PAGE', '20'))
+ALBUMS_PER_PAGE = int(os.getenv('ALBUMS_PER_PAGE', '30'))
+PHOTOS_PER_PAGE = int(os.getenv('PHOTOS_PER_PAGE', '100'))
+
+# Browser caching for proxied renditions. Responses depend on the signed-in
+# user, so they are cacheable by the browser only, never by shared proxies.
+THUMBNAIL_CACHE_CONTROL = 'private, max-age=604800, immutable'
+
+# When set (e.g. /adobe_proxy), /thumbnail hands rendition downloads to an
+# nginx internal location via X-Accel-Redirect instead of proxying the bytes
+# itself. Only enable this behind nginx configured as in nginx.conf.example.
+THUMBNAIL_ACCEL_PREFIX = os.getenv('THUMBNAIL_ACCEL_PREFIX', '').rstrip('/')
+
+
+class OrjsonProvider(JSONProvider):
+    """JSON provider using orjson for API responses and the tojson template filter"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.secret_key = os.getenv('FLASK_SECRET_KEY', 'dev-secret-key-change-in-production')
 
+# Optional Redis cache for catalog and album cover lookups
+REDIS_URL = os.getenv('REDIS_URL')
+redis_client = redis.from_url(REDIS_URL) if REDIS_URL else None
+
+# With Redis available, keep OAuth tokens server-side; the cookie then only
+# carries a session ID instead of the signed token data
+if redis_client is not None:
+    app.config.update(
+        SESSION_TYPE='redis',
+        SESSION_REDIS=redis_client,
+        SESSION_PERMANENT=False
+    )
+    Session(app)
+
 # Initialize OAuth handler
 oauth_handler = OAuthHandler(
     client_id=os.getenv('ADOBE_CLIENT_ID'),
@@ -42,7 +88,149 @@ oauth_handler = OAuthHandler(
 )
 
 # Initialize Lightroom client
-lightroom_client = LightroomClient(oauth_handler)
+lightroom_client = LightroomClient(oauth_handler, cache=redis_client)
+
+# Shared pool for concurrent Lightroom API calls, capped at the client's
+# connection pool size so every worker can hold its own keep-alive connection
+EXECUTOR = ThreadPoolExecutor(max_workers=min(16, LightroomClient.POOL_MAXSIZE))
+
+
+def store_token(token_data):
+    """Save an OAuth token response in the session"""
+    expires_in = token_data.get('expires_in', 3600)
+    session['access_token'] = token_data['access_token']
+    session['refresh_token'] = token_data.get('refresh_token', session.get('refresh_token'))
+    session['expires_in'] = expires_in
+    # Prefer the absolute expiry from the token cache; expires_in is relative
+    # to when the token was issued, which may be well before now
+    session['expires_at'] = token_data.get('expires_at') or time.time() + expires_in
+
+
+def get_access_token():
+    """
+    Get the session's access token, refreshing it shortly before it expires
+
+    Returns:
+        str: Valid OAuth access token
+    """
+    expires_at = session.get('expires_at')
+    refresh_token = session.get('refresh_token')
+    if expires_at and refresh_token and oauth_handler.token_needs_refresh(expires_at):
+        store_token(oauth_handler.refresh_access_token(refresh_token))
+    return session['access_token']
+
+
+# Included in relayed ETags so validators issued by a previous deploy, whose
+# code may have shaped responses differently, no longer match
+ETAG_VERSION = hashlib.sha1(
+    Path(__file__).read_bytes() + Path(__file__).with_name('lightroom_client.py').read_bytes()
+).hexdigest()[:12]
+
+
+def relay_etag(upstream_etag):
+    """
+    Build the ETag sent to the browser from a Lightroom API ETag
+
+    Args:
+        upstream_etag: ETag from the Lightroom API response, or None
+
+    Returns:
+        str: ETag combining ETAG_VERSION and the upstream ETag, or None
+    """
+    if not upstream_etag:
+        return None
+    weak = upstream_etag.startswith('W/')
+    tag = (upstream_etag[2:] if weak else upstream_etag).strip('"')
+    return f'{"W/" if weak else ""}"{ETAG_VERSION}.{tag}"'
+
+
+def upstream_if_none_match():
+    """
+    Recover the Lightroom API ETag from the browser's If-None-Match header
+
+    Returns:
+        str: Upstream ETag to revalidate against, or None if the browser's
+            ETag is missing or was issued by a different app version
+    """
+    if_none_match = request.headers.get('If-None-Match', '').strip()
+    weak = if_none_match.startswith('W/')
+    tag = (if_none_match[2:] if weak else if_none_match).strip('"')
+    prefix = f"{ETAG_VERSION}."
+    if not tag.startswith(prefix):
+        return None
+    return f'{"W/" if weak else ""}"{tag[len(prefix):]}"'
+
+
+def etag_headers(etag):
+    """
+    Build headers relaying an ETag to the browser
+
+    The browser is told to revalidate on every use, so its If-None-Match can
+    be passed through to the Lightroom API.
+
+    Args:
+        etag: ETag built by relay_etag, or None
+
+    Returns:
+        dict: Response headers
+    """
+    if not etag:
+        return {}
+    return {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+
+
+def attach_first_asset_ids(access_token, albums_list):
+    """
+    Enrich each album with the ID of its first asset for thumbnail display
+
+    The album's cover asset is used when the album payload names one. For
+    the remaining albums, cached IDs are read in a single batch and cache
+    misses are fetched from the Lightroom API concurrently.
+
+    Args:
+        access_token: OAuth access token
+        albums_list: List of album resources, updated in place
+
+    Returns:
+        bool: True if every lookup succeeded, False if any album was left
+            without a thumbnail because its lookup failed
+    """
+    first_asset_ids = {}
+    lookup_ids = []
+    for album in albums_list:
+        album_id = album.get('id')
+        if not album_id:
+            continue
+        payload = album.get('payload') or {}
+        cover_id = (payload.get('cover') or {}).get('id') or payload.get('coverId')
+        if cover_id:
+            first_asset_ids[album_id] = cover_id
+        else:
+            lookup_ids.append(album_id)
+
+    first_asset_ids.update(lightroom_client.get_cached_album_first_assets(lookup_ids))
+
+    def fetch_first_asset(album_id):
+        try:
+            asset_id = lightroom_client.get_album_first_asset(
+                access_token, album_id, check_cache=False, raise_errors=True
+            )
+            return asset_id, True
+        except Exception:
+            return None, False
+
+    misses = [album_id for album_id in lookup_ids if album_id not in first_asset_ids]
+    complete = True
+    for album_id, (asset_id, ok) in zip(misses, EXECUTOR.map(fetch_first_asset, misses)):
+        first_asset_ids[album_id] = asset_id
+        complete = complete and ok
+
+    for album in albums_list:
+        album_id = album.get('id')
+        if album_id:
+            album['first_asset_id'] = first_asset_ids[album_id]
+
+    return complete
 
 
 @app.route('/')
@@ -68,7 +256,10 @@ def oauth_start():
     if 'access_token' in session:
         return redirect(url_for('albums'))
 
-    auth_url = oauth_handler.get_authorization_url()
+    # Keep the CSRF state in the user's session so the callback can be
+    # validated by whichever worker process handles it
+    auth_url, state = oauth_handler.get_authorization_url()
+    session['oauth_state'] = state
     return redirect(auth_url)
 
 
@@ -88,11 +279,11 @@ def callback():
     
     try:
         # Exchange authorization code for access token
-        # Pass state parameter for validation
-        token_data = oauth_handler.get_access_token(code, state=state)
-        session['access_token'] = token_data['access_token']
-        session['refresh_token'] = token_data.get('refresh_token')
-        session['expires_in'] = token_data.get('expires_in', 3600)
+        # Pass state parameter for validation against the one issued to this session
+        token_data = oauth_handler.get_access_token(
+            code, state=state, expected_state=session.pop('oauth_state', None)
+        )
+        store_token(token_data)
         
         return redirect(url_for('albums'))
     except Exception as e:
@@ -108,17 +299,15 @@ def albums():
         return redirect(url_for('login'))
 
     try:
-        access_token = session['access_token']
-        albums_list, next_name_after = lightroom_client.get_albums_page(
+        access_token = get_access_token()
+        # No ETag relay here: the rendered page also depends on templates and
+        # first-asset lookups that the upstream album list ETag does not cover
+        albums_list, next_name_after, _ = lightroom_client.get_albums_page(
             access_token, limit=ALBUMS_PER_PAGE, name_after=None
         )
 
         # Enrich each album with the first asset ID for thumbnail display
-        for album in albums_list:
-            album_id = album.get('id')
-            if album_id:
-                first_asset_id = lightroom_client.get_album_first_asset(access_token, album_id)
-                album['first_asset_id'] = first_asset_id
+        attach_first_asset_ids(access_token, albums_list)
 
         return render_template(
             'albums.html',
@@ -140,29 +329,36 @@ def albums_api():
         return {"error": "name_after parameter required"}, 400
 
     try:
-        access_token = session['access_token']
-        albums_list, next_name_after = lightroom_client.get_albums_page(
-            access_token, limit=ALBUMS_PER_PAGE, name_after=name_after
+        access_token = get_access_token()
+        albums_list, next_name_after, upstream_etag = lightroom_client.get_albums_page(
+            access_token, limit=ALBUMS_PER_PAGE, name_after=name_after,
+            if_none_match=upstream_if_none_match()
         )
-
-        # Enrich and transform albums to simpler format
+        etag = relay_etag(upstream_etag)
+        if albums_list is NOT_MODIFIED:
+            return '', 304, etag_headers(etag)
+
+        # Enrich and transform albums to simpler format.
+        # A failed first-asset lookup must not be pinned in the browser by a
+        # relayed ETag, so such responses go out without one.
+        if not attach_first_asset_ids(access_token, albums_list):
+            etag = None
         albums_data = []
         for album in albums_list:
             album_id = album.get('id')
             if album_id:
-                first_asset_id = lightroom_client.get_album_first_asset(access_token, album_id)
                 payload = album.get('payload', {})
                 albums_data.append({
                     'id': album_id,
                     'name': payload.get('name', 'Untitled Album'),
                     'asset_count': payload.get('assetCount', 0),
-                    'first_asset_id': first_asset_id
+                    'first_asset_id': album.get('first_asset_id')
                 })
 
         return {
             'albums': albums_data,
             'next_name_after': next_name_after
-        }
+        }, etag_headers(etag)
     except Exception as e:
         return {"error": str(e)}, 500
 
@@ -178,7 +374,7 @@ def album_view(album_id):
         page_url = None
 
     try:
-        access_token = session['access_token']
+        access_token = get_access_token()
         album_info = lightroom_client.get_album(access_token, album_id)
         photos, next_url, prev_url = lightroom_client.get_album_assets_page(
             access_token, album_id, limit=PHOTOS_PER_PAGE, page_url=page_url
@@ -207,7 +403,7 @@ def album_photos_api(album_id):
         return {"error": "page_url parameter required"}, 400
 
     try:
-        access_token = session['access_token']
+        access_token = get_access_token()
         photos, next_url, _ = lightroom_client.get_album_assets_page(
             access_token, album_id, limit=PHOTOS_PER_PAGE, page_url=page_url
         )
@@ -245,15 +441,51 @@ def thumbnail(asset_id):
     if rendition_type not in allowed_types:
         return f"Invalid rendition type. Allowed: {', '.join(allowed_types)}", 400
 
+    # Renditions are addressed by (asset_id, type), so the browser can
+    # revalidate without us contacting Lightroom at all
+    etag = hashlib.sha1(f"{asset_id}:{rendition_type}".encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = THUMBNAIL_CACHE_CONTROL
+        return response
+
     try:
-        access_token = session['access_token']
+        access_token = get_access_token()
+
+        if THUMBNAIL_ACCEL_PREFIX:
+            # Let nginx fetch (and cache) the image from Lightroom directly
+            url, upstream_headers = lightroom_client.get_asset_rendition_request(
+                access_token, asset_id, rendition_type=rendition_type
+            )
+            response = Response(headers={
+                'X-Accel-Redirect': f"{THUMBNAIL_ACCEL_PREFIX}{urlparse(url).path}",
+                'X-Lightroom-Authorization': upstream_headers['Authorization'],
+                'X-Lightroom-Api-Key': upstream_headers['x-api-key'],
+                'Cache-Control': THUMBNAIL_CACHE_CONTROL
+            })
+            response.set_etag(etag)
+            return response
+
         # Fetch image data from Lightroom API
-        image_data = lightroom_client.get_asset_rendition(
+        rendition = lightroom_client.get_asset_rendition(
             access_token, asset_id, rendition_type=rendition_type
         )
 
-        # Return image with appropriate content type
-        return Response(image_data, mimetype='image/jpeg')
+        # Stream the image through as it arrives rather than buffering it
+        headers = {'Cache-Control': THUMBNAIL_CACHE_CONTROL}
+        # iter_content() decodes any Content-Encoding, so the upstream length
+        # only matches the bytes we send for unencoded bodies
+        if rendition.headers.get('Content-Length') and not rendition.headers.get('Content-Encoding'):
+            headers['Content-Length'] = rendition.headers['Content-Length']
+        response = Response(
+            rendition.iter_content(lightroom_client.RENDITION_CHUNK_SIZE),
+            mimetype=rendition.headers.get('Content-Type', 'image/jpeg'),
+            headers=headers
+        )
+        response.set_etag(etag)
+        response.call_on_close(rendition.close)
+        return response
     except Exception as e:
         # Return a simple error response
         return f"Error fetching image: {str(e)}", 500
@@ -267,27 +499,23 @@ def logout():
 
 
 if __name__ == '__main__':
-    import ssl
-    
     port = int(os.getenv('PORT', 8443))
     debug = os.getenv('FLASK_DEBUG', 'False').lower() == 'true'
     
-    # SSL configuration
+    # SSL configuration (under gunicorn, TLS is configured in gunicorn.conf.py instead)
     cert_file = os.getenv('SSL_CERT_FILE', 'cert.pem')
     key_file = os.getenv('SSL_KEY_FILE', 'key.pem')
     
-    ssl_context = None
-    
-    # Try to use provided SSL certificates
-    if os.path.exists(cert_file) and os.path.exists(key_file):
+    # Use provided SSL certificates, or an adhoc self-signed certificate for development
+    if Path(cert_file).is_file() and Path(key_file).is_file():
         ssl_context = (cert_file, key_file)
-        print(f"Using SSL certificates: {cert_file}, {key_file}")
+        logger.info("Using SSL certificates: %s, %s", cert_file, key_file)
     else:
-        # Use adhoc SSL context for development (self-signed certificate)
         ssl_context = 'adhoc'
-        print("Warning: Using adhoc SSL context (self-signed certificate).")
-        print("For production, provide SSL certificates via SSL_CERT_FILE and SSL_KEY_FILE environment variables.")
-        print(f"Expected files: {cert_file}, {key_file}")
+        logger.warning(
+            "Using adhoc SSL context (self-signed certificate); expected files: %s, %s. "
+            "For production, provide SSL certificates via SSL_CERT_FILE and SSL_KEY_FILE environment variables.",
+            cert_file, key_file
+        )
     
     app.run(host='0.0.0.0', port=port, debug=debug, ssl_context=ssl_context)
-
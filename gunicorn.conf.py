@@ -0,0 +1,27 @@
+"""
+Gunicorn configuration for production deployments
+Run with: gunicorn -c gunicorn.conf.py app:app
+
+gevent workers monkey-patch the standard library before the app is
+imported, so Lightroom API calls yield cooperatively instead of blocking
+a worker per in-flight request.
+"""
+
+import os
+import multiprocessing
+from pathlib import Path
+
+# GUNICORN_BIND overrides the address entirely, e.g. 127.0.0.1:8000 behind nginx
+bind = os.getenv('GUNICORN_BIND', f"0.0.0.0:{os.getenv('PORT', '8443')}")
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'gevent'
+worker_connections = int(os.getenv('WORKER_CONNECTIONS', '1000'))
+
+# TLS is terminated by gunicorn when certificates are available, unless
+# GUNICORN_TLS=false (e.g. when nginx terminates TLS in front of it)
+gunicorn_tls = os.getenv('GUNICORN_TLS', 'true').lower() == 'true'
+cert_file = os.getenv('SSL_CERT_FILE', 'cert.pem')
+key_file = os.getenv('SSL_KEY_FILE', 'key.pem')
+if gunicorn_tls and Path(cert_file).is_file() and Path(key_file).is_file():
+    certfile = cert_file
+    keyfile = key_file
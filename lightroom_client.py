@@ -4,32 +4,90 @@ Handles API calls to Adobe Lightroom API
 """
 
 import re
-import json
+import hashlib
 import logging
-from urllib.parse import urljoin, urlparse, parse_qs, urlencode, urlunparse
+import threading
+from urllib.parse import urljoin, urlparse, parse_qs, urlencode, urlunparse, quote
 
+import cachetools
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from oauth_handler import OAuthHandler
 
 # Set up logger
 logger = logging.getLogger(__name__)
 
+# Adobe prepends while(1){} to JSON responses; the literal form is the common
+# case, the regex (from Adobe documentation) covers whitespace variants
+_WHILE1_LITERAL = 'while(1){}'
+_WHILE1_RE = re.compile(r'^while\s*\(\s*1\s*\)\s*{\s*}\s*', re.IGNORECASE)
+
+# Returned in place of a response body when a conditional request gets a 304
+NOT_MODIFIED = object()
+
 class LightroomClient:
     """Client for interacting with Adobe Lightroom API"""
     
-    catalog = None
-    
     # Lightroom API base URL
     API_BASE_URL = "https://lr.adobe.io/v2"
+
+    # (connect, read) timeouts in seconds for API and rendition requests
+    API_TIMEOUT = (3.05, 30)
+    RENDITION_TIMEOUT = (3.05, 60)
+
+    # Per-host connection pool size; concurrent callers beyond POOL_MAXSIZE
+    # would open throwaway connections instead of reusing keep-alive ones
+    POOL_CONNECTIONS = 32
+    POOL_MAXSIZE = 64
+
+    # Chunk size in bytes when streaming rendition bodies
+    RENDITION_CHUNK_SIZE = 64 * 1024
+
+    # Cache TTLs in seconds for album cover assets and catalog lookups
+    FIRST_ASSET_CACHE_TTL = 3600
+    CATALOG_CACHE_TTL = 86400
     
-    def __init__(self, oauth_handler):
+    def __init__(self, oauth_handler, cache=None):
         """
         Initialize Lightroom client
         
         Args:
             oauth_handler: OAuthHandler instance for authentication
+            cache: Optional Redis client used to cache catalog and first-asset lookups
         """
         self.oauth_handler = oauth_handler
+        self.cache = cache
+
+        # Headers shared by every API request; only Authorization varies per call
+        self._base_headers = {
+            # Adobe requires x-api-key to be the client ID
+            'x-api-key': oauth_handler.client_id,
+            'Content-Type': 'application/json'
+        }
+
+        # In-process catalog cache keyed per user (by access token hash),
+        # checked before the optional shared cache
+        self._catalog_cache = cachetools.TTLCache(maxsize=1024, ttl=self.CATALOG_CACHE_TTL)
+        self._catalog_lock = threading.Lock()
+
+        # Reuse one pooled session so keep-alive connections to lr.adobe.io
+        # are shared across requests instead of re-doing the TLS handshake
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=self.POOL_CONNECTIONS,
+            pool_maxsize=self.POOL_MAXSIZE,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.3,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=["GET"],
+                # Surface the final error response via raise_for_status()
+                raise_on_status=False
+            )
+        )
+        self.session.mount("https://", adapter)
     
     def _process_json_response(self, response_text):
         """
@@ -47,23 +105,62 @@ class LightroomClient:
         if not response_text:
             return None
         
-        # Strip the while(1){} prefix using regex pattern from Adobe documentation
-        # Pattern matches: while(1){} with optional whitespace
-        while1_regex = re.compile(r'^while\s*\(\s*1\s*\)\s*{\s*}\s*', re.IGNORECASE)
-        cleaned_text = while1_regex.sub('', response_text)
+        # Strip the while(1){} prefix, skipping the regex for the canonical form
+        if response_text.startswith(_WHILE1_LITERAL):
+            cleaned_text = response_text[len(_WHILE1_LITERAL):].lstrip()
+        else:
+            cleaned_text = _WHILE1_RE.sub('', response_text)
         
-        return json.loads(cleaned_text)
+        return orjson.loads(cleaned_text)
     
+    @staticmethod
+    def _first_asset_cache_key(album_id):
+        """Cache key for an album's first asset ID"""
+        return f"lr:first_asset:{album_id}"
+
+    @staticmethod
+    def _catalog_cache_key(access_token):
+        """Cache key for a user's catalog, derived from a hash of the access token"""
+        return f"lr:catalog:{hashlib.sha256(access_token.encode()).hexdigest()}"
+
+    def _cache_get(self, key):
+        """Read a value from the cache, treating cache errors as a miss"""
+        if self.cache is None:
+            return None
+        try:
+            return self.cache.get(key)
+        except Exception as e:
+            logger.warning("Cache read failed for %s: %s", key, e)
+            return None
+
+    def _cache_mget(self, keys):
+        """Read several values from the cache in one round trip, treating cache errors as misses"""
+        if self.cache is None or not keys:
+            return [None] * len(keys)
+        try:
+            return self.cache.mget(keys)
+        except Exception as e:
+            logger.warning("Cache batch read failed: %s", e)
+            return [None] * len(keys)
+
+    def _cache_set(self, key, ttl, value):
+        """Write a value to the cache with a TTL, ignoring cache errors"""
+        if self.cache is None:
+            return
+        try:
+            self.cache.setex(key, ttl, value)
+        except Exception as e:
+            logger.warning("Cache write failed for %s: %s", key, e)
+
     def _get_headers(self, access_token):
         """Get headers for API requests"""
-        return {
-            'Authorization': f'Bearer {access_token}',
-            # Adobe requires x-api-key to be the client ID
-            'x-api-key': self.oauth_handler.client_id,
-            'Content-Type': 'application/json'
-        }
+        return {**self._base_headers, 'Authorization': f'Bearer {access_token}'}
+
+    def _get_safe_headers(self):
+        """Get request headers for logging, with the authorization header masked"""
+        return {**self._base_headers, 'Authorization': 'Bearer ***REDACTED***'}
     
-    def _make_request(self, access_token, method, endpoint, **kwargs):
+    def _make_request(self, access_token, method, endpoint, if_none_match=None, with_etag=False, **kwargs):
         """
         Make API request with error handling
 
@@ -71,10 +168,13 @@ class LightroomClient:
             access_token: OAuth access token
             method: HTTP method (GET, POST, etc.)
             endpoint: API endpoint path or absolute URL
+            if_none_match: ETag to send as If-None-Match for a conditional request
+            with_etag: Also return the response ETag
             **kwargs: Additional arguments for requests
 
         Returns:
-            dict: JSON response
+            dict: JSON response, or NOT_MODIFIED if the server answered 304.
+                When with_etag is set, a (response, etag) tuple.
         """
         # Support both relative endpoints and absolute URLs, per Adobe links/base docs:
         # https://developer.adobe.com/lightroom/lightroom-api-docs/guides/links_and_pagination/
@@ -84,34 +184,48 @@ class LightroomClient:
             url = f"{self.API_BASE_URL}{endpoint}"
 
         headers = self._get_headers(access_token)
+        if if_none_match:
+            headers['If-None-Match'] = if_none_match
 
         # Log request details (mask sensitive authorization header)
-        safe_headers = headers.copy()
-        if 'Authorization' in safe_headers:
-            safe_headers['Authorization'] = 'Bearer ***REDACTED***'
-        logger.info(f"Lightroom API Request: {method} {url}")
-        logger.debug(f"Request headers: {safe_headers}")
-        if kwargs:
-            logger.debug(f"Request kwargs: {kwargs}")
+        logger.info("Lightroom API Request: %s %s", method, url)
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug("Request headers: %s", self._get_safe_headers())
+            if kwargs:
+                logger.debug("Request kwargs: %s", kwargs)
 
-        response = requests.request(method, url, headers=headers, **kwargs)
+        kwargs.setdefault('timeout', self.API_TIMEOUT)
+        response = self.session.request(method, url, headers=headers, **kwargs)
+        response_text = response.text
 
         # Log response details
-        logger.info(f"Lightroom API Response: {response.status_code} from {method} {url}")
-        logger.debug(f"Response headers: {dict(response.headers)}")
-        logger.debug(f"Response body length: {len(response.text)} characters")
+        logger.info("Lightroom API Response: %s from %s %s", response.status_code, method, url)
+        if debug:
+            logger.debug("Response headers: %s", response.headers)
+            logger.debug("Response body length: %s characters", len(response_text))
 
         # Handle token expiration
         if response.status_code == 401:
-            logger.error(f"Access token expired for request to {url}")
+            logger.error("Access token expired for request to %s", url)
             raise Exception("Access token expired. Please re-authenticate.")
 
         response.raise_for_status()
 
-        # Process JSON response to strip while(1){} prefix
-        # Adobe Lightroom API prepends this to all JSON responses
-        resp = self._process_json_response(response.text)
-        logger.debug(f"Response body: \n{json.dumps(resp, indent=4)}")
+        etag = response.headers.get('ETag')
+        if response.status_code == 304:
+            resp = NOT_MODIFIED
+            etag = etag or if_none_match
+        else:
+            # Process JSON response to strip while(1){} prefix
+            # Adobe Lightroom API prepends this to all JSON responses
+            resp = self._process_json_response(response_text)
+            # Only serialize the body for logging when DEBUG is actually enabled
+            if debug:
+                logger.debug("Response body:\n%s", orjson.dumps(resp, option=orjson.OPT_INDENT_2).decode())
+
+        if with_etag:
+            return resp, etag
         return resp
 
     def _get_paged_resources(self, access_token, initial_endpoint):
@@ -155,14 +269,27 @@ class LightroomClient:
         Returns:
             dict: Catalog information
         """
-        if (self.catalog is not None):
-            return self.catalog
+        key = self._catalog_cache_key(access_token)
+        with self._catalog_lock:
+            catalog = self._catalog_cache.get(key)
+        if catalog is not None:
+            return catalog
+
+        cached = self._cache_get(key)
+        if cached is not None:
+            catalog = orjson.loads(cached)
         else:
-            self.catalog = self._make_request(access_token, 'GET', '/catalog')
-            return self.catalog
+            catalog = self._make_request(access_token, 'GET', '/catalog')
+            if catalog:
+                self._cache_set(key, self.CATALOG_CACHE_TTL, orjson.dumps(catalog))
+
+        if catalog:
+            with self._catalog_lock:
+                self._catalog_cache[key] = catalog
+        return catalog
     
 
-    def get_albums_page(self, access_token, limit=20, name_after=None):
+    def get_albums_page(self, access_token, limit=20, name_after=None, if_none_match=None):
         """
         Get a single page of albums using cursor-based pagination
 
@@ -170,11 +297,13 @@ class LightroomClient:
             access_token: OAuth access token
             limit: Number of albums per page
             name_after: Cursor for pagination (album name to start after)
+            if_none_match: ETag from a previous response to revalidate against
 
         Returns:
-            tuple: (albums_list, next_name_after)
-                - albums_list: List of album resources
+            tuple: (albums_list, next_name_after, etag)
+                - albums_list: List of album resources, or NOT_MODIFIED if unchanged since if_none_match
                 - next_name_after: Value for name_after to get next page, or None if no more pages
+                - etag: ETag of the album page, or None if not provided by the API
         """
         catalog = self.get_catalog(access_token)
         if not catalog:
@@ -183,15 +312,21 @@ class LightroomClient:
         if not catalog_id:
             raise Exception("Could not retrieve catalog ID")
 
-        # Build endpoint with name_after parameter if provided
-        endpoint = f'/catalogs/{catalog_id}/albums?limit={int(limit)}'
+        # Build endpoint with name_after parameter if provided, percent-encoding
+        # album names that contain characters such as spaces, & or =
+        params = {'limit': int(limit)}
         if name_after:
-            endpoint += f'&name_after={name_after}'
+            params['name_after'] = name_after
+        endpoint = f'/catalogs/{catalog_id}/albums?{urlencode(params, quote_via=quote)}'
 
-        page = self._make_request(access_token, 'GET', endpoint)
+        page, etag = self._make_request(
+            access_token, 'GET', endpoint, if_none_match=if_none_match, with_etag=True
+        )
 
+        if page is NOT_MODIFIED:
+            return NOT_MODIFIED, None, etag
         if not page:
-            return [], None
+            return [], None, etag
 
         resources = page.get('resources', [])
         links = page.get('links', {})
@@ -207,7 +342,7 @@ class LightroomClient:
             if 'name_after' in qs and qs['name_after']:
                 next_name_after = qs['name_after'][0]
 
-        return resources, next_name_after
+        return resources, next_name_after, etag
     
     def get_album(self, access_token, album_id):
         """
@@ -244,7 +379,7 @@ class LightroomClient:
         if page_url:
             page = self._make_request(access_token, 'GET', page_url)
         else:
-            endpoint = f'/catalogs/{catalog_id}/albums/{album_id}/assets?limit={int(limit)}'
+            endpoint = f'/catalogs/{catalog_id}/albums/{album_id}/assets?{urlencode({"limit": int(limit)})}'
             page = self._make_request(access_token, 'GET', endpoint)
 
         if not page:
@@ -282,17 +417,43 @@ class LightroomClient:
 
         return resources, next_url, prev_url
 
-    def get_album_first_asset(self, access_token, album_id):
+    def get_cached_album_first_assets(self, album_ids):
+        """
+        Look up cached first asset IDs for several albums in one cache round trip
+
+        Args:
+            album_ids: List of album IDs
+
+        Returns:
+            dict: Album ID to first asset ID (None for empty albums), for cache hits only
+        """
+        keys = [self._first_asset_cache_key(album_id) for album_id in album_ids]
+        cached = {}
+        for album_id, value in zip(album_ids, self._cache_mget(keys)):
+            if value is not None:
+                cached[album_id] = value.decode() or None
+        return cached
+
+    def get_album_first_asset(self, access_token, album_id, check_cache=True, raise_errors=False):
         """
         Get the first asset from an album
 
         Args:
             access_token: OAuth access token
             album_id: Album ID
+            check_cache: Whether to look in the cache before calling the API
+            raise_errors: Re-raise lookup failures instead of returning None,
+                so callers can tell a failure apart from an empty album
 
         Returns:
-            str: First asset ID or None if album is empty
+            str: First asset ID or None if album is empty (or the lookup failed)
         """
+        key = self._first_asset_cache_key(album_id)
+        if check_cache:
+            cached = self._cache_get(key)
+            if cached is not None:
+                return cached.decode() or None
+
         try:
             catalog = self.get_catalog(access_token)
             if not catalog:
@@ -305,19 +466,24 @@ class LightroomClient:
             endpoint = f'/catalogs/{catalog_id}/albums/{album_id}/assets?limit=1'
             page = self._make_request(access_token, 'GET', endpoint)
 
+            asset_id = None
             if page and page.get('resources'):
                 first_asset = page['resources'][0]
                 # Extract asset ID from the resource structure
-                return first_asset.get('asset', {}).get('id')
+                asset_id = first_asset.get('asset', {}).get('id')
 
-            return None
+            # Empty albums are cached as "" so they are not looked up again
+            self._cache_set(key, self.FIRST_ASSET_CACHE_TTL, asset_id or "")
+            return asset_id
         except Exception as e:
-            logger.warning(f"Failed to fetch first asset for album {album_id}: {str(e)}")
+            logger.warning("Failed to fetch first asset for album %s: %s", album_id, e)
+            if raise_errors:
+                raise
             return None
 
-    def get_asset_rendition(self, access_token, asset_id, rendition_type='2048'):
+    def get_asset_rendition_request(self, access_token, asset_id, rendition_type='2048'):
         """
-        Get rendition image data for an asset
+        Build the URL and headers for fetching an asset rendition
 
         Args:
             access_token: OAuth access token
@@ -325,7 +491,7 @@ class LightroomClient:
             rendition_type: Type of rendition (e.g., '2048', 'thumbnail2x', 'thumbnail')
 
         Returns:
-            bytes: Image binary data
+            tuple: (url, headers) for a GET of the rendition
         """
         catalog = self.get_catalog(access_token)
         if not catalog:
@@ -335,28 +501,48 @@ class LightroomClient:
             raise Exception("Could not retrieve catalog ID")
 
         url = f"{self.API_BASE_URL}/catalogs/{catalog_id}/assets/{asset_id}/renditions/{rendition_type}"
-        headers = self._get_headers(access_token)
+        return url, self._get_headers(access_token)
 
-        # Log request
-        safe_headers = headers.copy()
-        if 'Authorization' in safe_headers:
-            safe_headers['Authorization'] = 'Bearer ***REDACTED***'
-        logger.info(f"Lightroom API Request: GET {url}")
-        logger.debug(f"Request headers: {safe_headers}")
+    def get_asset_rendition(self, access_token, asset_id, rendition_type='2048'):
+        """
+        Get rendition image data for an asset
 
-        response = requests.get(url, headers=headers)
+        The body is not read up front; iterate the response with
+        iter_content(RENDITION_CHUNK_SIZE) and close it when done.
+
+        Args:
+            access_token: OAuth access token
+            asset_id: Asset ID
+            rendition_type: Type of rendition (e.g., '2048', 'thumbnail2x', 'thumbnail')
+
+        Returns:
+            requests.Response: Streamed response for the image binary data
+        """
+        url, headers = self.get_asset_rendition_request(access_token, asset_id, rendition_type)
+
+        # Log request (mask sensitive authorization header)
+        logger.info("Lightroom API Request: GET %s", url)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Request headers: %s", self._get_safe_headers())
+
+        response = self.session.get(url, headers=headers, timeout=self.RENDITION_TIMEOUT, stream=True)
 
         # Log response
-        logger.info(f"Lightroom API Response: {response.status_code} from GET {url}")
-        logger.debug(f"Response Content-Type: {response.headers.get('Content-Type')}")
-        logger.debug(f"Response body length: {len(response.content)} bytes")
+        logger.info("Lightroom API Response: %s from GET %s", response.status_code, url)
+        logger.debug("Response Content-Type: %s", response.headers.get('Content-Type'))
+        logger.debug("Response Content-Length: %s bytes", response.headers.get('Content-Length'))
 
         # Handle token expiration
         if response.status_code == 401:
-            logger.error(f"Access token expired for request to {url}")
+            response.close()
+            logger.error("Access token expired for request to %s", url)
             raise Exception("Access token expired. Please re-authenticate.")
 
-        response.raise_for_status()
+        try:
+            response.raise_for_status()
+        except requests.HTTPError:
+            response.close()
+            raise
 
-        return response.content
+        return response
 
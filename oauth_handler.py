@@ -4,9 +4,14 @@ Handles authentication flow using OAuth 2.0 authorization code grant
 """
 
 import logging
+import threading
+import time
+import weakref
+import cachetools
 import requests
 import secrets
 from urllib.parse import urlencode
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 
 # Set up logger
@@ -28,6 +33,12 @@ class OAuthHandler:
     # - openid: standard OpenID Connect scope
     # - lr_partner_apis: access general Lightroom partner APIs
     SCOPE = "offline_access,AdobeID,lr_partner_rendition_apis,openid,lr_partner_apis"
+
+    # (connect, read) timeouts in seconds for token requests
+    TOKEN_TIMEOUT = (3.05, 30)
+
+    # Treat access tokens as expired this many seconds early
+    TOKEN_REFRESH_MARGIN = 60
     
     def __init__(self, client_id, client_secret, redirect_uri):
         """
@@ -44,35 +55,52 @@ class OAuthHandler:
         self.client_id = client_id
         self.client_secret = client_secret
         self.redirect_uri = redirect_uri
-        self.state = None
+
+        # Only the state varies between authorization URLs, so encode the rest once
+        self._auth_url_prefix = f"{self.AUTHORIZATION_URL}?" + urlencode({
+            'client_id': client_id,
+            'redirect_uri': redirect_uri,
+            'response_type': 'code',
+            'scope': self.SCOPE
+        }) + '&state='
+
+        # Pooled session for ims-na1.adobelogin.com token requests.
+        # Token POSTs are not retried since authorization codes are single-use.
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+        # Refreshed tokens keyed by refresh token, so concurrent requests in
+        # this process holding the same expiring token share a single refresh.
+        # _token_lock only guards the cache and lock table; each refresh token
+        # gets its own lock so one slow token request does not block others.
+        self._token_cache = cachetools.TTLCache(maxsize=1024, ttl=86400)
+        self._token_lock = threading.Lock()
+        self._refresh_locks = weakref.WeakValueDictionary()
     
     def get_authorization_url(self):
         """
         Generate authorization URL for OAuth2 flow
+
+        The state is returned rather than stored on the handler, since the
+        handler is shared by all users and worker processes; keep it in the
+        user's session and pass it back to get_access_token.
         
         Returns:
-            str: Authorization URL to redirect user to
+            tuple: (authorization_url, state)
         """
-        # Generate state for CSRF protection
-        self.state = secrets.token_urlsafe(32)
+        # Generate state for CSRF protection (already URL-safe, so no encoding needed)
+        state = secrets.token_urlsafe(32)
         
-        params = {
-            'client_id': self.client_id,
-            'redirect_uri': self.redirect_uri,
-            'response_type': 'code',
-            'scope': self.SCOPE,
-            'state': self.state
-        }
-        
-        return f"{self.AUTHORIZATION_URL}?{urlencode(params)}"
+        return self._auth_url_prefix + state, state
     
-    def get_access_token(self, authorization_code, state=None):
+    def get_access_token(self, authorization_code, state=None, expected_state=None):
         """
         Exchange authorization code for access token
 
         Args:
             authorization_code: Authorization code from callback
-            state: State parameter for CSRF validation (optional)
+            state: State parameter returned to the callback
+            expected_state: State issued by get_authorization_url for this user
 
         Returns:
             dict: Token response containing access_token, refresh_token, etc.
@@ -81,7 +109,7 @@ class OAuthHandler:
             ValueError: If state validation fails
             requests.HTTPError: If token exchange fails
         """
-        if state and state != self.state:
+        if not expected_state or not secrets.compare_digest(state or '', expected_state):
             raise ValueError("Invalid state parameter")
 
         data = {
@@ -102,16 +130,18 @@ class OAuthHandler:
         # Log request (mask sensitive data)
         safe_data = data.copy()
         safe_data['code'] = '***REDACTED***'
-        logger.info(f"OAuth Token Request: POST {self.TOKEN_URL}")
-        logger.debug(f"Request data: {safe_data}")
-        logger.debug(f"Request headers: {headers}")
+        logger.info("OAuth Token Request: POST %s", self.TOKEN_URL)
+        logger.debug("Request data: %s", safe_data)
+        logger.debug("Request headers: %s", headers)
 
         try:
-            response = requests.post(self.TOKEN_URL, data=data, headers=headers, auth=auth)
+            response = self.session.post(
+                self.TOKEN_URL, data=data, headers=headers, auth=auth, timeout=self.TOKEN_TIMEOUT
+            )
 
             # Log response
-            logger.info(f"OAuth Token Response: {response.status_code} from POST {self.TOKEN_URL}")
-            logger.debug(f"Response headers: {dict(response.headers)}")
+            logger.info("OAuth Token Response: %s from POST %s", response.status_code, self.TOKEN_URL)
+            logger.debug("Response headers: %s", response.headers)
 
             # If request failed, provide detailed error information
             if not response.ok:
@@ -122,7 +152,7 @@ class OAuthHandler:
                 except (ValueError, requests.exceptions.JSONDecodeError):
                     error_detail = response.text or f"HTTP {response.status_code}"
 
-                logger.error(f"Token exchange failed: {error_detail} (Status: {response.status_code})")
+                logger.error("Token exchange failed: %s (Status: %s)", error_detail, response.status_code)
                 raise requests.HTTPError(
                     f"Token exchange failed: {error_detail} (Status: {response.status_code})"
                 )
@@ -133,19 +163,60 @@ class OAuthHandler:
         except requests.HTTPError:
             raise
         except Exception as e:
-            logger.error(f"Unexpected error during token exchange: {str(e)}")
+            logger.error("Unexpected error during token exchange: %s", e)
             raise Exception(f"Unexpected error during token exchange: {str(e)}")
     
+    def token_needs_refresh(self, expires_at):
+        """
+        Check whether an access token should be refreshed
+
+        Args:
+            expires_at: Unix timestamp at which the access token expires
+
+        Returns:
+            bool: True if the token expires within TOKEN_REFRESH_MARGIN seconds
+        """
+        return time.time() >= expires_at - self.TOKEN_REFRESH_MARGIN
+
     def refresh_access_token(self, refresh_token):
         """
         Refresh an expired access token
 
+        Recently refreshed tokens are reused until they are close to expiry,
+        so each process hits the token endpoint once per refresh token rather
+        than once per request.
+
         Args:
             refresh_token: Refresh token from initial authentication
 
         Returns:
-            dict: New token response
+            dict: New token response, plus an 'expires_at' Unix timestamp. For
+                cached tokens 'expires_in' is relative to the original refresh,
+                so use 'expires_at' for the real expiry.
         """
+        with self._get_refresh_lock(refresh_token):
+            with self._token_lock:
+                cached = self._token_cache.get(refresh_token)
+            if cached is not None and not self.token_needs_refresh(cached['expires_at']):
+                return dict(cached)
+
+            token_data = self._request_token_refresh(refresh_token)
+            token_data['expires_at'] = time.time() + token_data.get('expires_in', 3600)
+            with self._token_lock:
+                self._token_cache[refresh_token] = token_data
+            return dict(token_data)
+
+    def _get_refresh_lock(self, refresh_token):
+        """Get the lock serializing refreshes of a single refresh token"""
+        with self._token_lock:
+            lock = self._refresh_locks.get(refresh_token)
+            if lock is None:
+                lock = threading.Lock()
+                self._refresh_locks[refresh_token] = lock
+            return lock
+
+    def _request_token_refresh(self, refresh_token):
+        """Exchange a refresh token for a new access token at the token endpoint"""
         data = {
             'grant_type': 'refresh_token',
             'refresh_token': refresh_token
@@ -163,21 +234,23 @@ class OAuthHandler:
         # Log request (mask sensitive data)
         safe_data = data.copy()
         safe_data['refresh_token'] = '***REDACTED***'
-        logger.info(f"OAuth Token Refresh Request: POST {self.TOKEN_URL}")
-        logger.debug(f"Request data: {safe_data}")
-        logger.debug(f"Request headers: {headers}")
+        logger.info("OAuth Token Refresh Request: POST %s", self.TOKEN_URL)
+        logger.debug("Request data: %s", safe_data)
+        logger.debug("Request headers: %s", headers)
 
-        response = requests.post(self.TOKEN_URL, data=data, headers=headers, auth=auth)
+        response = self.session.post(
+            self.TOKEN_URL, data=data, headers=headers, auth=auth, timeout=self.TOKEN_TIMEOUT
+        )
 
         # Log response
-        logger.info(f"OAuth Token Refresh Response: {response.status_code} from POST {self.TOKEN_URL}")
-        logger.debug(f"Response headers: {dict(response.headers)}")
+        logger.info("OAuth Token Refresh Response: %s from POST %s", response.status_code, self.TOKEN_URL)
+        logger.debug("Response headers: %s", response.headers)
 
         try:
             response.raise_for_status()
             logger.info("Access token refreshed successfully")
         except requests.HTTPError as e:
-            logger.error(f"Token refresh failed: {response.status_code} - {response.text}")
+            logger.error("Token refresh failed: %s - %s", response.status_code, response.text)
             raise
 
         return response.json()